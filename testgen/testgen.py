@@ -1,18 +1,30 @@
 #!/usr/bin/env python3
 
 import os
+import io
 import pathlib
-import csv
+import queue
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from operator import attrgetter
+from typing import NamedTuple
+from urllib.request import urlopen
 import chess
 import chess.engine
+import zstandard
 
 
-class Puzzle:
-    def __init__(self, puzzle_id: str, fen: str, rating: int, moves: list[str]):
-        self.puzzle_id = puzzle_id
-        self.fen = fen
-        self.rating = rating
-        self.moves = moves
+PUZZLE_COUNT = 100
+BUFFER_SIZE = 1 << 20
+
+
+class Puzzle(NamedTuple):
+    puzzle_id: str
+    fen: str
+    rating: int
+    first_move: chess.Move
+    best_move: str
 
 
 def download_puzzle_db(download_path: pathlib.Path):
@@ -25,30 +37,75 @@ def download_puzzle_db(download_path: pathlib.Path):
 
     url = "https://database.lichess.org/lichess_db_puzzle.csv.zst"
 
-    os.system(f"wget {url} -O {download_path}")
+    # download to a temporary file first so an interrupted download is not
+    # mistaken for a complete one on the next run
+    partial_path = download_path.with_name(download_path.name + ".part")
+
+    # the timeout applies to each blocking read, so only a stalled connection
+    # aborts the download
+    with urlopen(url, timeout=60) as response, open(partial_path, "wb") as f:
+        total = int(response.headers.get("Content-Length", 0))
+        done = 0
+
+        while chunk := response.read(BUFFER_SIZE):
+            f.write(chunk)
+            done += len(chunk)
+
+            if total:
+                progress = f"{done / total:.0%} ({done >> 20}/{total >> 20} MiB)"
+            else:
+                progress = f"{done >> 20} MiB"
+
+            print(f"\rDownloaded {progress}", end="", flush=True)
+
+        print()
+
+    partial_path.replace(download_path)
+
+
+def open_puzzle_db(puzzles_path: pathlib.Path) -> io.TextIOBase:
+    if puzzles_path.suffix != ".zst":
+        return open(
+            puzzles_path, "r", buffering=BUFFER_SIZE, encoding="utf-8", newline=""
+        )
+
+    # closing the text wrapper closes the decompressor and the file under it
+    decompressed = zstandard.ZstdDecompressor().stream_reader(
+        open(puzzles_path, "rb", buffering=BUFFER_SIZE), read_size=BUFFER_SIZE
+    )
+
+    return io.TextIOWrapper(
+        io.BufferedReader(decompressed, buffer_size=BUFFER_SIZE),
+        encoding="utf-8",
+        newline="",
+    )
 
 
 def generate_list(puzzles_path: pathlib.Path, n: int) -> list[Puzzle]:
     puzzles: list[Puzzle] = []
 
-    with open(puzzles_path, "r") as f:
-        reader = csv.reader(f)
-
-        next(reader)
+    with open_puzzle_db(puzzles_path) as f:
+        next(f)
 
-        for row in reader:
-            (puzzle_id, fen, moves, rating, _, _, _, _, _, _) = row
+        for line in f:
+            # none of the columns we need contain quoted commas, so there is
+            # no need to go through the `csv` module
+            (puzzle_id, fen, moves, rating, _) = line.split(",", 4)
 
-            moves = moves.split(" ")
+            # only the setup move and the expected reply are used
+            (first_move, _, moves) = moves.partition(" ")
+            (best_move, _, _) = moves.partition(" ")
 
-            puzzle = Puzzle(puzzle_id, fen, int(rating), moves)
+            puzzle = Puzzle(
+                puzzle_id, fen, int(rating), chess.Move.from_uci(first_move), best_move
+            )
 
             puzzles.append(puzzle)
 
             if len(puzzles) >= n:
                 break
 
-    puzzles = sorted(puzzles, key=lambda x: x.rating)
+    puzzles.sort(key=attrgetter("rating"))
 
     return puzzles
 
@@ -59,92 +116,170 @@ def download_puzzles() -> pathlib.Path:
     )
     puzzles_path = download_path.parent / "lichess_db_puzzle.csv"
 
+    # older versions of this script decompressed the database to disk, so
+    # reuse that copy instead of downloading the database again
     if puzzles_path.exists():
         print(f"`{puzzles_path}` already exists, skipping download")
-        print("If you want to redownload, delete the file and run the script again")
+        print("You can delete it to use the compressed database instead")
         return puzzles_path
 
     download_puzzle_db(download_path)
 
-    os.system(f"zstd --decompress {download_path}")
+    return download_path
 
-    os.remove(download_path)
 
-    return puzzles_path
+def build_engine():
+    # always go through cargo: its fingerprinting also notices changed
+    # features, flags, toolchains and dependencies, and a no-op build is cheap
+    subprocess.run(["cargo", "build", "--profile", "full"], check=True)
 
 
-def main(engine: chess.engine.SimpleEngine):
-    puzzles_path = download_puzzles()
+def analyse_puzzle(
+    engines: list[chess.engine.SimpleEngine],
+    idle_engines: "queue.Queue[chess.engine.SimpleEngine | None]",
+    dead_engines: list[chess.engine.SimpleEngine],
+    limit: chess.engine.Limit,
+    puzzle: Puzzle,
+) -> tuple[chess.Board, chess.engine.InfoDict]:
+    board = chess.Board(puzzle.fen)
 
-    print(f"Generating list of puzzles from {puzzles_path}")
+    # the setup move comes from the puzzle database, so skip the legality
+    # check that `push_uci` would do
+    board.push(puzzle.first_move)
 
-    limit = chess.engine.Limit(time=1.0)
+    # each engine process is a single UCI session, so borrow one exclusively
+    # for the duration of the search
+    engine = idle_engines.get()
 
-    engine.configure({"Hash": 64})
+    if engine is None:
+        # pass the marker on so the other workers stop waiting as well
+        idle_engines.put(None)
+        raise RuntimeError(
+            f"Puzzle {puzzle.puzzle_id} not searched, fen: {board.fen()}: "
+            "all engines have terminated"
+        )
 
-    print(f"Searching with {limit}")
+    try:
+        info = engine.analyse(board, limit)
+    except chess.engine.EngineTerminatedError as e:
+        # don't hand a dead engine to the next puzzle
+        dead_engines.append(engine)
 
-    print(f'Running engine `{engine.id["name"]}`')
+        if len(dead_engines) == len(engines):
+            idle_engines.put(None)
 
-    puzzles = generate_list(puzzles_path, 100)
+        raise RuntimeError(
+            f"Puzzle {puzzle.puzzle_id} crashed the engine, fen: {board.fen()}: {e}"
+        ) from e
+    except Exception as e:
+        idle_engines.put(engine)
 
-    for i, puzzle in enumerate(puzzles):
-        board = chess.Board(puzzle.fen)
+        raise RuntimeError(
+            f"Puzzle {puzzle.puzzle_id} failed, fen: {board.fen()}: {e}"
+        ) from e
 
-        board.push_uci(puzzle.moves[0])
+    idle_engines.put(engine)
 
-        print(
-            f"---\nPuzzle {i + 1}\tid: {puzzle.puzzle_id}, r: {puzzle.rating}, fen: {board.fen()}"
-        )
+    return board, info
 
-        info = engine.analyse(board, limit)
 
-        score = info.get("score")
-        best_move = (info.get("pv") or [chess.Move.from_uci("0000")])[0]
-        depth = info.get("depth")
-        seldepth = info.get("seldepth")
-        nodes = info.get("nodes")
-        nps = info.get("nps")
+def main(engines: list[chess.engine.SimpleEngine]):
+    puzzles_path = download_puzzles()
 
-        nps_str = ""
+    limit = chess.engine.Limit(time=1.0)
 
-        if nps is not None:
-            if nps > 1_000:
-                nps_str = f"{nps / 1_000_000:.1f}M"
-            else:
-                nps_str = f"{nps}"
+    idle_engines: "queue.Queue[chess.engine.SimpleEngine | None]" = queue.Queue()
+    dead_engines: list[chess.engine.SimpleEngine] = []
+
+    for engine in engines:
+        engine.configure({"Hash": 64})
+        idle_engines.put(engine)
+
+    print(f"Searching with {limit}")
 
-        if score is not None:
-            score = score.relative
+    print(f'Running engine `{engines[0].id["name"]}` ({len(engines)} instances)')
 
-        uci_best_move = best_move.uci()
-        puzzle_best_move = puzzle.moves[1]
+    print(f"Generating list of puzzles from {puzzles_path}")
+
+    puzzles = generate_list(puzzles_path, PUZZLE_COUNT)
 
-        if uci_best_move == puzzle_best_move:
-            print(f"Correct move:  \t{uci_best_move}")
-            print(f"Depth:         \t{depth}/{seldepth}")
-            print(f"Nodes:         \t{nodes}")
-            print(f"NPS:           \t{nps_str}")
-            print(f"Relative score:\t{score}")
-        else:
-            print(f"Wrong move:    \tfound {best_move}, best: {puzzle_best_move}")
-            print(f"Depth:         \t{depth}/{seldepth}")
-            print(f"Nodes:         \t{nodes}")
-            print(f"NPS:           \t{nps_str}")
-            print(f"Relative score:\t{score}")
-            return
+    executor = ThreadPoolExecutor(max_workers=len(engines))
+
+    try:
+        results = executor.map(
+            partial(analyse_puzzle, engines, idle_engines, dead_engines, limit),
+            puzzles,
+        )
+
+        for i, (puzzle, (board, info)) in enumerate(zip(puzzles, results)):
+            print(
+                f"---\nPuzzle {i + 1}\tid: {puzzle.puzzle_id}, r: {puzzle.rating}, fen: {board.fen()}"
+            )
+
+            score = info.get("score")
+            best_move = (info.get("pv") or [chess.Move.from_uci("0000")])[0]
+            depth = info.get("depth")
+            seldepth = info.get("seldepth")
+            nodes = info.get("nodes")
+            nps = info.get("nps")
+
+            nps_str = ""
+
+            if nps is not None:
+                if nps > 1_000:
+                    nps_str = f"{nps / 1_000_000:.1f}M"
+                else:
+                    nps_str = f"{nps}"
+
+            if score is not None:
+                score = score.relative
+
+            uci_best_move = best_move.uci()
+            puzzle_best_move = puzzle.best_move
+
+            if uci_best_move == puzzle_best_move:
+                print(f"Correct move:  \t{uci_best_move}")
+                print(f"Depth:         \t{depth}/{seldepth}")
+                print(f"Nodes:         \t{nodes}")
+                print(f"NPS:           \t{nps_str}")
+                print(f"Relative score:\t{score}")
+            else:
+                print(f"Wrong move:    \tfound {best_move}, best: {puzzle_best_move}")
+                print(f"Depth:         \t{depth}/{seldepth}")
+                print(f"Nodes:         \t{nodes}")
+                print(f"NPS:           \t{nps_str}")
+                print(f"Relative score:\t{score}")
+                return
+    finally:
+        executor.shutdown(cancel_futures=True)
 
 
 if __name__ == "__main__":
     engine_cmd = "../target/full/eccat"
-    os.system("cargo build --profile full")
+    build_engine()
 
-    engine = chess.engine.SimpleEngine.popen_uci(engine_cmd)
+    # `os.cpu_count` includes SMT siblings, which share a core and so slow
+    # down each other's fixed-time searches; `TESTGEN_ENGINES` overrides it
+    engine_count = max(
+        1, int(os.environ.get("TESTGEN_ENGINES", os.cpu_count() or 1))
+    )
+
+    engines: list[chess.engine.SimpleEngine] = []
 
     try:
-        main(engine)
+        # start the engines inside the `try` so the ones that did start are
+        # still shut down if a later one fails or the user interrupts
+        for _ in range(min(PUZZLE_COUNT, engine_count)):
+            engines.append(chess.engine.SimpleEngine.popen_uci(engine_cmd))
+
+        main(engines)
     except Exception as e:
         print(e)
     finally:
-        engine.quit()
-        print("Engine quit")
+        for engine in engines:
+            try:
+                engine.quit()
+            except chess.engine.EngineTerminatedError:
+                # the engine already died, there is nothing left to shut down
+                pass
+        print("Engines quit")